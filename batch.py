@@ -0,0 +1,234 @@
+"""
+저장된 사전으로 여러 검색어를 한꺼번에 검색하거나, 중복된 단어를 찾습니다.
+
+    python -m batch < queries.jsonl > results.jsonl
+    python -m batch --duplicates --sense-columns 3 > duplicates.jsonl
+
+검색어는 한 줄에 하나씩 `{"dictionary": "사전 이름", "query": "검색어", "count": 5}` 형태로 입력합니다.
+사전의 행은 봇이 저장한 `res/snapshots`에서 읽으며, 사전 정보에 `rows`가 있으면 그 행을 대신 사용합니다.
+"""
+import sys
+from argparse import ArgumentParser
+from asyncio import run
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from json import JSONDecodeError, dumps, load, loads
+from os import cpu_count
+
+from database import SNAPSHOT_DIRECTORY, Database, SnapshotSheet, snapshot_path
+
+# dictionaries of the current (worker) process, name -> (database, dictionary json)
+databases = dict()
+
+
+def load_databases(dictionaries_path: str, snapshot_directory: str) -> dict:
+    """ 사전 정보 파일의 사전들을 저장된 행으로부터 불러옵니다. """
+    with open(dictionaries_path, 'r', encoding='utf-8') as file:
+        dictionaries = load(file)
+
+    result = dict()
+    for dictionary_json in dictionaries:
+        name = dictionary_json['name']
+        spreadsheet_id = dictionary_json.get('spreadsheet_id', name)
+        sheet_index = dictionary_json.get('sheet_index', 0)
+
+        # use given rows or the snapshot saved by the bot
+        if 'rows' in dictionary_json:
+            sheet = SnapshotSheet(dictionary_json['rows'])
+        else:
+            file_path = snapshot_path(spreadsheet_id, sheet_index, snapshot_directory)
+            try:
+                sheet = SnapshotSheet.load(file_path)
+            except FileNotFoundError:
+                print(f'snapshot not found: {name} ({file_path})', file=sys.stderr)
+                continue
+            except (JSONDecodeError, UnicodeDecodeError) as e:
+                print(f'snapshot is corrupt: {name} ({file_path}): {e}', file=sys.stderr)
+                continue
+
+        result[name] = (Database(spreadsheet_id, sheet_index, sheet=sheet), dictionary_json)
+    return result
+
+
+def init_worker(dictionaries_path: str, snapshot_directory: str):
+    global databases
+    databases = load_databases(dictionaries_path, snapshot_directory)
+
+
+async def search(query: dict) -> dict:
+    result = dict(query)
+    if 'error' in query:
+        return result
+    if query['dictionary'] not in databases:
+        result['error'] = f'dictionary not found: {query.get("dictionary")}'
+        return result
+
+    database, dictionary_json = databases[query['dictionary']]
+    rows = await database.search_rows(
+        query.get('query', ''), dictionary_json.get('word_column', 0),
+        dictionary_json.get('exclude_columns'), dictionary_json.get('hidden_columns')
+    )
+
+    # perfectly matched words are marked as `__word__`
+    result['results'] = list()
+    for rank, (word, values) in enumerate(rows[: max(0, min(query.get('count', 25), 25))], start=1):
+        perfect = len(word) > 4 and word.startswith('__') and word.endswith('__')
+        if perfect:
+            word = word[2:-2]
+        result['results'].append({'rank': rank, 'word': word, 'perfect': perfect, 'values': values})
+    return result
+
+
+async def search_all(queries: list) -> list:
+    return [await search(query) for query in queries]
+
+
+def search_batch(queries: list) -> list:
+    return run(search_all(queries))
+
+
+def read_queries(file):
+    for line_number, line in enumerate(file, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            query = loads(line)
+        except JSONDecodeError as e:
+            query = {'line': line_number, 'error': f'invalid json: {e}'}
+        if not isinstance(query, dict):
+            query = {'line': line_number, 'error': 'query must be a json object'}
+        elif 'error' not in query:
+            error = check_query(query)
+            if error is not None:
+                query = {'line': line_number, **query, 'error': error}
+        yield query
+
+
+def check_query(query: dict):
+    """ 검색어 형식이 잘못되었으면 오류 메시지를 반환합니다. """
+    if not isinstance(query.get('dictionary'), str):
+        return '`dictionary` must be a string'
+    if not isinstance(query.get('query', ''), str):
+        return '`query` must be a string'
+    count = query.get('count', 25)
+    if not isinstance(count, int) or isinstance(count, bool):
+        return '`count` must be an integer'
+    return None
+
+
+def batches(iterable, size: int):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def write_results(results: list, file):
+    for result in results:
+        file.write(dumps(result, ensure_ascii=False) + '\n')
+
+
+def run_searches(args, input_file, output_file):
+    # search in this process
+    if args.jobs == 1:
+        init_worker(args.dictionaries, args.snapshots)
+        for batch in batches(read_queries(input_file), args.batch_size):
+            write_results(search_batch(batch), output_file)
+        return
+
+    # fan batches out over worker processes, keeping only a few batches in flight
+    with ProcessPoolExecutor(
+        args.jobs, initializer=init_worker, initargs=(args.dictionaries, args.snapshots)
+    ) as executor:
+        pending = deque()
+        for batch in batches(read_queries(input_file), args.batch_size):
+            pending.append(executor.submit(search_batch, batch))
+            if len(pending) >= args.jobs * 2:
+                write_results(pending.popleft().result(), output_file)
+        while pending:
+            write_results(pending.popleft().result(), output_file)
+
+
+def run_duplicates(args, output_file):
+    for name, (database, dictionary_json) in load_databases(args.dictionaries, args.snapshots).items():
+        duplicates = database.find_duplicates(
+            dictionary_json.get('word_column', 0), dictionary_json.get('exclude_columns'),
+            dictionary_json.get('hidden_columns'), args.sense_columns
+        )
+        write_results(({'dictionary': name, **duplicate} for duplicate in duplicates), output_file)
+
+
+def parse_args():
+    parser = ArgumentParser(prog='python -m batch', description='저장된 사전으로 검색어를 한꺼번에 검색합니다.')
+
+    parser._actions[0].help = '도움말 메시지를 보여주고 종료합니다'
+    parser.add_argument(
+        'input',
+        nargs='?',
+        help='검색어 JSONL 파일. 입력하지 않으면 표준 입력에서 읽습니다',
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        help='결과를 저장할 JSONL 파일. 입력하지 않으면 표준 출력으로 씁니다',
+    )
+    parser.add_argument(
+        '-d',
+        '--dictionaries',
+        default='res/dictionaries.json',
+        help='사전 정보 파일',
+    )
+    parser.add_argument(
+        '-s',
+        '--snapshots',
+        default=SNAPSHOT_DIRECTORY,
+        help='봇이 저장한 사전 행 디렉터리',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=cpu_count() or 1,
+        help='검색에 사용할 프로세스 수',
+    )
+    parser.add_argument(
+        '-b',
+        '--batch-size',
+        type=int,
+        default=256,
+        help='프로세스에 한 번에 보낼 검색어 수',
+    )
+    parser.add_argument(
+        '--duplicates',
+        action='store_true',
+        help='검색 대신 사전마다 단어나 뜻이 겹치는 행들을 찾습니다',
+    )
+    parser.add_argument(
+        '--sense-columns',
+        type=lambda x: list(map(lambda y: int(y) - 1, x.split(','))),
+        help='`--duplicates`에서 뜻으로 볼 열. `,`로 구분된 정수로 입력하며, 입력하지 않으면 단어만 비교합니다. '
+        '제외 열과 숨김 열은 뜻으로 보지 않습니다',
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    output_file = sys.stdout if args.output is None else open(args.output, 'w', encoding='utf-8')
+    try:
+        if args.duplicates:
+            run_duplicates(args, output_file)
+        elif args.input is None:
+            run_searches(args, sys.stdin, output_file)
+        else:
+            with open(args.input, 'r', encoding='utf-8') as input_file:
+                run_searches(args, input_file, output_file)
+    finally:
+        if output_file is not sys.stdout:
+            output_file.close()
+
+
+if __name__ == '__main__':
+    main()
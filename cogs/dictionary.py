@@ -1,6 +1,8 @@
 import re
+from asyncio import create_task, to_thread, Task
 from datetime import datetime, timedelta
 from dataclasses import dataclass, asdict, field
+from functools import partial
 from json import load, dump
 
 from discord import Interaction, Embed, Reaction, Member, MessageType
@@ -10,6 +12,7 @@ from gspread.exceptions import SpreadsheetNotFound
 
 from consts import get_const
 from database import Database
+from singleflight import SingleFlight
 from util import generate_dictionary_url, similarity
 
 
@@ -49,7 +52,7 @@ class Dictionary:
         embed.add_field(name="색상", value=f"#{self.color:06X}")
         embed.add_field(name="제외 열", value=f"{list(map(lambda x: x + 1, self.exclude_columns))}")
         embed.add_field(name="숨김 열", value=f"{list(map(lambda x: x + 1, self.hidden_columns))}")
-        embed.add_field(name="단어 수", value=f"{len(self.database.sheet_values)-1}개")
+        embed.add_field(name="단어 수", value=f"{max(0, len(self.database.sheet_values)-1)}개")
 
         return embed
 
@@ -59,7 +62,7 @@ def load_dictionary(dictionary_json) -> Dictionary | None:
     spreadsheet_id = dictionary_json["spreadsheet_id"]
     sheet_index = dictionary_json["sheet_index"]
     try:
-        database = Database(spreadsheet_id, sheet_index)
+        database = Database(spreadsheet_id, sheet_index, lazy=True)
     except PermissionError:
         return None
     return Dictionary(database=database, **dictionary_json)
@@ -68,6 +71,9 @@ def load_dictionary(dictionary_json) -> Dictionary | None:
 class DictionaryCog(Cog):
     def __init__(self, bot):
         self.bot: Bot = bot
+        self.load_tasks = set()
+        self.reload_flights = SingleFlight()
+        self.search_flights = SingleFlight()
 
         # load dictionaries from file
         with open("res/dictionaries.json", "r", encoding="utf-8") as file:
@@ -88,6 +94,48 @@ class DictionaryCog(Cog):
                 map(lambda x: asdict(x, dict_factory=x.dict_factory), self.dictionaries)
             )
             dump(data, file, ensure_ascii=False)
+
+    @staticmethod
+    async def save_snapshot(database: Database):
+        """ 사전을 `python -m batch`에서 쓸 수 있도록 저장합니다. 저장하지 못해도 사전은 그대로 사용합니다. """
+        try:
+            await to_thread(database.save_snapshot)
+        except Exception as e:
+            print(f"Failed to save snapshot of `{database.spreadsheet_key}`: {e!r}")
+
+    async def load_database(self, database: Database):
+        """ 사전을 불러오고 `python -m batch`에서 쓸 수 있도록 저장합니다. """
+        await database.load()
+        await self.save_snapshot(database)
+
+    async def reload_database(self, dictionary: Dictionary):
+        """ 사전을 다시 불러오고 `python -m batch`에서 쓸 수 있도록 저장합니다. """
+        database = dictionary.database
+        await database.reload_async(dictionary.word_column)
+        await self.save_snapshot(database)
+
+    @Cog.listener()
+    async def on_ready(self):
+        """ 아직 불러오지 않은 사전들을 나누어 불러옵니다. """
+        for dictionary in self.dictionaries:
+            database = dictionary.database
+            if database.loaded or database.loading:
+                continue
+            # share the flight with reloads, so a load never runs alongside a reload
+            task = create_task(self.reload_flights.do(database, self.load_database, database))
+            self.load_tasks.add(task)
+            task.add_done_callback(self.load_tasks.discard)
+            task.add_done_callback(partial(self.check_load, dictionary))
+
+    @staticmethod
+    def check_load(dictionary: Dictionary, task: Task):
+        """ 사전을 불러오지 못했으면 오류를 출력하고 사전을 실패 상태로 표시합니다. """
+        if task.cancelled() or task.exception() is None:
+            return
+        print(f"Failed to load dictionary `{dictionary.name}`: {task.exception()!r}")
+        # a dictionary keeps its rows if the load joined a reload that failed
+        if not dictionary.database.loaded:
+            dictionary.database.failed = True
     
     @Cog.listener()
     async def on_reaction_add(self, reaction: Reaction, user: Member):
@@ -105,7 +153,7 @@ class DictionaryCog(Cog):
     @command(name="검색", description="단어를 검색합니다.")
     @describe(
         conlang_name="검색할 사전의 이름",
-        query="검색어",
+        query="검색어 (예: `품사=명사 의미:물`, `단어^=ka OR 단어^=ko`)",
         count="검색 결과 개수",
         ephemeral="결과 비공개 여부",
     )
@@ -129,14 +177,28 @@ class DictionaryCog(Cog):
             )
             return
 
+        # check if dictionary failed to load
+        if database.failed:
+            await ctx.response.send_message(
+                f"`{conlang_name}` 사전을 불러오지 못했습니다. `/사전 새로고침`으로 다시 불러올 수 있습니다.",
+                ephemeral=True,
+            )
+            return
+
         # check if last greater than 7 days from last reload
-        reloading = database.last_reload + timedelta(days=7) < datetime.now()
+        reloading = database.loaded and database.last_reload + timedelta(days=7) < datetime.now()
         if reloading:
             await ctx.response.defer(ephemeral=ephemeral)
-            database.reload()
+            await self.reload_flights.do(database, self.reload_database, dictionary)
 
-        # search rows by query
-        rows = await database.search_rows(
+        # search rows by query, sharing the result with identical searches in flight
+        # the raw query is used, as `OR` and `AND` keywords are case-sensitive
+        search_key = (
+            database, query, dictionary.word_column,
+            tuple(dictionary.exclude_columns), tuple(dictionary.hidden_columns),
+        )
+        rows = await self.search_flights.do(
+            search_key, database.search_rows,
             query, dictionary.word_column, dictionary.exclude_columns, dictionary.hidden_columns
         )
 
@@ -147,6 +209,8 @@ class DictionaryCog(Cog):
             url=generate_dictionary_url(dictionary.spreadsheet_id),
             description=f"`{query}` 검색 결과",
         )
+        if not database.loaded:
+            embed.description += " (사전을 불러오는 중이므로 일부 결과만 표시합니다.)"
         for word, values in rows[: max(0, min(count, 25))]:
             result = list()
             for key, value in values.items():
@@ -174,11 +238,16 @@ class DictionaryCog(Cog):
             )
             return
 
-        # send result message
-        await ctx.response.send_message(
-            embed=dictionary.get_embed(self.bot), ephemeral=True
+        # add request coalescing metrics
+        embed = dictionary.get_embed(self.bot)
+        embed.set_footer(
+            text=f"합쳐진 요청: 새로고침 {self.reload_flights.coalesced}/{self.reload_flights.calls}회, "
+                 f"검색 {self.search_flights.coalesced}/{self.search_flights.calls}회"
         )
 
+        # send result message
+        await ctx.response.send_message(embed=embed, ephemeral=True)
+
     @dictionary_group.command(name="추가", description="사전을 추가합니다.")
     @describe(
         name="사전 이름",
@@ -353,7 +422,7 @@ class DictionaryCog(Cog):
                     "단어 열은 1 이상의 정수를 입력해야 합니다.", ephemeral=True
                 )
                 return
-            if word_column > len(dictionary.database.sheet_values[0]):
+            if word_column > len(dictionary.database.header or []):
                 await ctx.response.send_message(
                     "단어 열 인덱스가 열 개수를 초과합니다.", ephemeral=True
                 )
@@ -479,13 +548,24 @@ class DictionaryCog(Cog):
             )
             return
 
+        # check if dictionary is still loading
+        if database.loading:
+            await ctx.response.send_message(
+                f"`{name}` 사전을 불러오는 중입니다. 잠시 후 다시 시도해주세요.", ephemeral=True
+            )
+            return
+
         await ctx.response.defer(ephemeral=True)
 
-        # reload dictionary
-        database.reload()
+        # reload dictionary, sharing a reload already in flight
+        await self.reload_flights.do(database, self.reload_database, dictionary)
 
         # send result message
-        await ctx.edit_original_response(content=f'`{name}` 사전이 새로고침되었습니다.')
+        changes = database.changes
+        await ctx.edit_original_response(
+            content=f'`{name}` 사전이 새로고침되었습니다. '
+                    f'(추가 {changes.inserted}개, 수정 {changes.updated}개, 삭제 {changes.deleted}개)'
+        )
 
     @search.autocomplete("conlang_name")
     @dictionary_info.autocomplete("name")
@@ -1,38 +1,391 @@
 import re
+from asyncio import sleep, to_thread
+from collections import Counter
+from dataclasses import dataclass
 from datetime import datetime
+from json import dump, load
+from os import makedirs, path, remove, replace
+from tempfile import NamedTemporaryFile
 from typing import Optional
 
 import gspread
 
+from query import ColumnIndex, match, parse_query
 from util import normalise, similarity, wait
 
+CHUNK_SIZE = 1000
+SEARCH_YIELD_ROWS = 1000
+SNAPSHOT_DIRECTORY = 'res/snapshots'
+
+
+def snapshot_path(spreadsheet_key: str, sheet_number: int, directory: str = SNAPSHOT_DIRECTORY) -> str:
+    return path.join(directory, f'{spreadsheet_key}-{sheet_number}.json')
+
+
+class SnapshotSheet:
+    """ 저장된 행 목록을 워크시트처럼 읽습니다. """
+
+    def __init__(self, rows: list):
+        self.rows = rows
+
+    @classmethod
+    def load(cls, file_path: str):
+        with open(file_path, 'r', encoding='utf-8') as file:
+            return cls(load(file))
+
+    @property
+    def row_count(self) -> int:
+        return len(self.rows)
+
+    def get_values(self, range_name: str) -> list:
+        start, end = map(int, range_name.split(':'))
+        return self.rows[start - 1:end]
+
+
+@dataclass
+class RowChanges:
+    inserted: int = 0
+    updated: int = 0
+    deleted: int = 0
+
 
 class Database:
     @staticmethod
-    def is_duplicate(query: str, row: list) -> bool:
-        return normalise(query) == normalise(row[0]) \
-               or any(normalise(query) in re.split(r'[,;] ', normalise(row[i])) for i in range(1, len(row)))
+    def index_cell(cell: str) -> list:
+        """ 셀을 검색에 사용할 정규화된 값들로 나눕니다. """
+        values = list()
+        for value in re.split(r', |; ', cell):
+            value = re.sub(r'(\[|\(|\{).+(\]|\)|\})', '', value).strip()
+            values.append(normalise(value))
+        return values
 
-    def __init__(self, spreadsheet_key: str, sheet_number: int = 0):
+    @staticmethod
+    def index_row(row: list) -> list:
+        return [Database.index_cell(cell) for cell in row]
+
+    @staticmethod
+    def trim_row(row: list) -> list:
+        # ranges are padded to their widest row, so trailing blank cells depend on other rows
+        while row and row[-1] == '':
+            row.pop()
+        return row
+
+    @staticmethod
+    def hash_row(row: list) -> int:
+        return hash(tuple(row))
+
+    def __init__(
+        self, spreadsheet_key: str, sheet_number: int = 0, chunk_size: int = CHUNK_SIZE, lazy: bool = False,
+        sheet: Optional[SnapshotSheet] = None
+    ):
         self.spreadsheet_key = spreadsheet_key
         self.sheet_number = sheet_number
+        self.chunk_size = chunk_size
 
-        print(f'load {spreadsheet_key}')
-        wait(5)
-        self.credential = gspread.service_account(filename='res/google_credentials.json')
-        self.sheet = self.credential.open_by_key(self.spreadsheet_key).get_worksheet(self.sheet_number)
+        # open worksheet unless rows are given
+        self.credential = None
+        self.sheet = sheet
+        if self.sheet is None:
+            print(f'load {spreadsheet_key}')
+            wait(5)
+            self.credential = gspread.service_account(filename='res/google_credentials.json')
+            self.sheet = self.credential.open_by_key(self.spreadsheet_key).get_worksheet(self.sheet_number)
 
         self.last_reload = datetime.now()
-        self.sheet_values = None
+        self.sheet_values = list()
+        self.search_values = list()
+        self.row_hashes = list()
+        self.row_ids = list()
+        self.row_positions = dict()
+        self.next_row_id = 0
+        self.column_indexes = list()
         self.header = None
-        self.reload()
+        self.changes = RowChanges()
+        self.loading = False
+        self.loaded = False
+        self.failed = False
+        if not lazy:
+            self.reload()
+
+    def fetch_row_count(self) -> int:
+        """ 시트 정보를 다시 불러와 현재 행 수를 반환합니다. """
+        # `row_count` is only read when the worksheet is opened
+        if self.credential is not None:
+            self.sheet = self.credential.open_by_key(self.spreadsheet_key).get_worksheet(self.sheet_number)
+        return self.sheet.row_count
+
+    def fetch_chunk(self, start: int, row_count: int) -> list:
+        """
+        `start`번째 행부터 최대 `chunk_size`개의 행을 끝의 빈 셀을 지우고 불러옵니다.
+        시트 범위를 넘는 행은 요청하지 않습니다.
+        """
+        rows = self.sheet.get_values(f'{start + 1}:{min(start + self.chunk_size, row_count)}')
+        return [self.trim_row(row) for row in rows]
+
+    def fill_blank_rows(self, start: int, rows: list, blank_rows: int, row_count: int) -> tuple:
+        """
+        청크 앞에 이전 청크 끝의 빈 행들을 채운 행 목록과, 이 청크 끝의 빈 행 수를 반환합니다.
+        시트는 범위 끝의 빈 행들을 보내지 않으므로, 뒤에 내용이 있는 빈 행만 채웁니다.
+        """
+        expected = min(self.chunk_size, row_count - start)
+        if not rows:
+            return rows, blank_rows + expected
+        return [list() for _ in range(blank_rows)] + rows, max(0, expected - len(rows))
+
+    def save_snapshot(self, directory: str = SNAPSHOT_DIRECTORY):
+        """ 불러온 행들을 `python -m batch`에서 읽을 수 있도록 파일로 저장합니다. """
+        makedirs(directory, exist_ok=True)
+
+        # write to a temporary file first, so readers never see a half-written snapshot
+        with NamedTemporaryFile('w', encoding='utf-8', dir=directory, suffix='.tmp', delete=False) as file:
+            try:
+                dump(self.sheet_values, file, ensure_ascii=False)
+            except BaseException:
+                file.close()
+                remove(file.name)
+                raise
+        replace(file.name, snapshot_path(self.spreadsheet_key, self.sheet_number, directory))
+
+    def clear(self):
+        self.sheet_values = list()
+        self.search_values = list()
+        self.row_hashes = list()
+        self.row_ids = list()
+        self.row_positions = dict()
+        self.next_row_id = 0
+        self.column_indexes = list()
+        self.header = None
+        self.loaded = False
+
+    def index_columns(self, row_id: int, values: list):
+        while len(self.column_indexes) < len(values):
+            self.column_indexes.append(ColumnIndex())
+        for j, cell_values in enumerate(values):
+            self.column_indexes[j].add(row_id, cell_values)
+
+    def unindex_columns(self, row_id: int, values: list):
+        for j, cell_values in enumerate(values):
+            self.column_indexes[j].remove(row_id, cell_values)
+
+    @staticmethod
+    def widen_header(header: list, rows: list):
+        # keep header as wide as the widest row, as `get_all_values` does
+        width = max(map(len, rows), default=0)
+        if width > len(header):
+            header.extend([''] * (width - len(header)))
+
+    def append_rows(self, rows: list):
+        """ 불러온 행들을 `sheet_values`에 추가하고 검색용 값을 만듭니다. """
+        for row in rows:
+            values = self.index_row(row)
+            row_id = self.next_row_id
+            self.next_row_id += 1
+            self.index_columns(row_id, values)
+            self.row_ids.append(row_id)
+            self.row_positions[row_id] = len(self.sheet_values)
+            self.sheet_values.append(row)
+            self.search_values.append(values)
+            self.row_hashes.append(self.hash_row(row))
+
+        if self.header is None and self.sheet_values:
+            self.header = list(self.sheet_values[0])
+        if self.header is not None:
+            self.widen_header(self.header, rows)
+
+    def build_snapshot(self, key_column: int = 0) -> dict:
+        """
+        사전을 다시 불러와 새 검색용 값들을 만듭니다. 내용이 바뀐 행만 다시 검색용 값을 만들며, `self`는 바꾸지 않습니다.
+        지워진 행과 추가된 행의 `key_column` 열 값이 같으면 수정된 행으로 셉니다.
+        """
+        def key(row: list) -> str:
+            return row[key_column] if key_column < len(row) else ''
+
+        # group current rows by content hash
+        previous = dict()
+        for row_hash, row, values, row_id in zip(self.row_hashes, self.sheet_values, self.search_values, self.row_ids):
+            previous.setdefault(row_hash, list()).append((row, values, row_id))
+
+        # reuse search values and ids of unchanged rows, index the others
+        sheet_values, search_values, row_hashes, row_ids = list(), list(), list(), list()
+        added_rows = list()
+        next_row_id = self.next_row_id
+        added = Counter()
+        row_count = self.fetch_row_count()
+        blank_rows = 0
+        for start in range(0, row_count, self.chunk_size):
+            chunk = self.fetch_chunk(start, row_count)
+            rows, blank_rows = self.fill_blank_rows(start, chunk, blank_rows, row_count)
+            for row in rows:
+                row_hash = self.hash_row(row)
+                candidates = previous.get(row_hash, list())
+                found = next((k for k, (old_row, _, _) in enumerate(candidates) if old_row == row), None)
+                if found is None:
+                    values = self.index_row(row)
+                    row_id = next_row_id
+                    next_row_id += 1
+                    added_rows.append((row_id, values))
+                    if any(row):
+                        added[key(row)] += 1
+                else:
+                    _, values, row_id = candidates.pop(found)
+                sheet_values.append(row)
+                search_values.append(values)
+                row_hashes.append(row_hash)
+                row_ids.append(row_id)
+
+        # rows left in `previous` are removed; a removed and an added row with the same key is an update
+        removed_rows = [(row_id, values) for candidates in previous.values() for _, values, row_id in candidates]
+        removed = Counter(key(old_row) for candidates in previous.values() for old_row, _, _ in candidates if any(old_row))
+        updated = sum((added & removed).values())
+        changes = RowChanges(
+            inserted=sum(added.values()) - updated,
+            updated=updated,
+            deleted=sum(removed.values()) - updated,
+        )
+
+        header = None
+        if sheet_values:
+            header = list(sheet_values[0])
+            self.widen_header(header, sheet_values)
 
-    def reload(self):
-        self.sheet_values = self.sheet.get_all_values()
+        return {
+            'sheet_values': sheet_values,
+            'search_values': search_values,
+            'row_hashes': row_hashes,
+            'row_ids': row_ids,
+            'row_positions': {row_id: i for i, row_id in enumerate(row_ids)},
+            'next_row_id': next_row_id,
+            'header': header,
+            'changes': changes,
+            'added_rows': added_rows,
+            'removed_rows': removed_rows,
+        }
+
+    def apply_snapshot(self, snapshot: dict):
+        # column indexes are keyed by row ids, so only changed rows are updated
+        for row_id, values in snapshot.pop('removed_rows'):
+            self.unindex_columns(row_id, values)
+        for row_id, values in snapshot.pop('added_rows'):
+            self.index_columns(row_id, values)
+
+        for key, value in snapshot.items():
+            setattr(self, key, value)
         self.last_reload = datetime.now()
-        self.header = self.sheet_values[0]
+        self.loaded = True
+        self.failed = False
+
+    def reload(self, key_column: int = 0):
+        self.apply_snapshot(self.build_snapshot(key_column))
+        return self
+
+    async def reload_async(self, key_column: int = 0):
+        """ 이벤트 루프를 막지 않고 사전을 다시 불러옵니다. """
+        self.apply_snapshot(await to_thread(self.build_snapshot, key_column))
         return self
 
+    async def load(self):
+        """ 사전을 `chunk_size`행씩 불러옵니다. 불러온 행은 바로 검색할 수 있습니다. """
+        if self.loading:
+            return self
+
+        self.loading = True
+        self.failed = False
+        try:
+            self.clear()
+            row_count = await to_thread(self.fetch_row_count)
+            blank_rows = 0
+            for start in range(0, row_count, self.chunk_size):
+                chunk = await to_thread(self.fetch_chunk, start, row_count)
+                rows, blank_rows = self.fill_blank_rows(start, chunk, blank_rows, row_count)
+                self.append_rows(rows)
+            self.last_reload = datetime.now()
+            self.loaded = True
+        finally:
+            self.loading = False
+        return self
+
+    def find_duplicates(
+        self, word_column: int, exclude_column_indexes: Optional[list] = None,
+        hidden_column_indexes: Optional[list] = None, sense_column_indexes: Optional[list] = None
+    ) -> list:
+        """
+        단어나 뜻이 겹치는 행들을 찾습니다. 정규화된 단어와 뜻을 해시로 묶으므로 행 수에 비례하는 시간이 걸립니다.
+        같은 단어(`word`), 같은 뜻(`sense`), 다른 행의 뜻과 같은 단어(`word_sense`)를 찾습니다.
+        `sense_column_indexes`를 주지 않으면 단어만 비교합니다. 제외 열과 숨김 열은 뜻으로 보지 않습니다.
+        """
+        if exclude_column_indexes is None:
+            exclude_column_indexes = list()
+        if hidden_column_indexes is None:
+            hidden_column_indexes = list()
+        if sense_column_indexes is None:
+            sense_column_indexes = list()
+
+        # hash rows by normalised words and senses
+        words, senses = dict(), dict()
+        for i, values in enumerate(self.search_values):
+            if i == 0:
+                continue
+            row_words, row_senses = set(), set()
+            for j, cell_values in enumerate(values):
+                if j in exclude_column_indexes:
+                    continue
+                if j == word_column:
+                    row_words.update(cell_values)
+                elif j in sense_column_indexes and j not in hidden_column_indexes:
+                    row_senses.update(cell_values)
+            for word in row_words:
+                if word:
+                    words.setdefault(word, list()).append(i)
+            for sense in row_senses:
+                if sense:
+                    senses.setdefault(sense, list()).append(i)
+
+        result = list()
+        for word, row_indexes in words.items():
+            if len(row_indexes) > 1:
+                result.append({
+                    'kind': 'word',
+                    'value': word,
+                    'rows': [self.sheet_values[i] for i in row_indexes],
+                    'identical': len(set(self.row_hashes[i] for i in row_indexes)) == 1,
+                })
+        for sense, row_indexes in senses.items():
+            if len(row_indexes) > 1:
+                result.append({
+                    'kind': 'sense',
+                    'value': sense,
+                    'rows': [self.sheet_values[i] for i in row_indexes],
+                })
+
+            # a word used as a sense of another row
+            word_rows = words.get(sense, list())
+            if not word_rows:
+                continue
+            word_row_set = set(word_rows)
+            sense_rows = [i for i in row_indexes if i not in word_row_set]
+            if sense_rows:
+                result.append({
+                    'kind': 'word_sense',
+                    'value': sense,
+                    'rows': [self.sheet_values[i] for i in word_rows],
+                    'sense_rows': [self.sheet_values[i] for i in sense_rows],
+                })
+
+        return result
+
+    def find_rows(self, term, exclude_column_indexes: list) -> set:
+        if term.column is not None:
+            if term.column >= len(self.column_indexes):
+                return set()
+            return self.column_indexes[term.column].find(term.operator, term.value)
+
+        rows = set()
+        for j, index in enumerate(self.column_indexes):
+            if j in exclude_column_indexes:
+                continue
+            rows |= index.find(term.operator, term.value)
+        return rows
+
     async def search_rows(
         self, query: str, word_column: int, exclude_column_indexes: Optional[list] = None,
         hidden_column_indexes: Optional[list] = None
@@ -43,28 +396,55 @@ class Database:
         if hidden_column_indexes is None:
             hidden_column_indexes = list()
 
-        # get similar row indexes
+        # keep the current snapshot, as reload may replace it while this search yields
+        sheet_values, search_values, header = self.sheet_values, self.search_values, self.header
+        row_positions = self.row_positions
+
+        # parse query with searchable column names
+        columns = dict()
+        for j, name in enumerate(header or list()):
+            if name and j not in exclude_column_indexes:
+                columns.setdefault(normalise(name), j)
+        groups = parse_query(query, columns)
+
+        # find rows matching every term of any group from column indexes
+        row_terms = dict()
+        for terms in groups:
+            rows = None
+            for term in terms:
+                found = self.find_rows(term, exclude_column_indexes)
+                rows = found if rows is None else rows & found
+                if not rows:
+                    break
+            rows = set(row_positions[row_id] for row_id in rows)
+            rows.discard(0)
+            for i in rows:
+                row_terms.setdefault(i, list()).extend(terms)
+
+        # calculate similarity of matched cell values
         perfect_match = set()
         row_indexes = list()
-        for i, row in enumerate(self.sheet_values):
-            # exclude first row
-            if i == 0:
-                continue
+        for k, i in enumerate(sorted(row_terms)):
+            # let other commands run while scoring many rows
+            if k and k % SEARCH_YIELD_ROWS == 0:
+                await sleep(0)
 
-            # calculate similarity if row cell has `query` in it
+            # terms scoped to columns other than the word column only filter rows
             sim = list()
-            for j, cell in enumerate(row):
-                if j in exclude_column_indexes:
+            for term in row_terms[i]:
+                if term.column is not None and term.column != word_column:
                     continue
-                values = re.split(r', |; ', cell)
-                for value in values:
-                    value = re.sub(r'(\[|\(|\{).+(\]|\)|\})', '', value).strip()
-                    if normalise(query) in normalise(value):
-                        sim.append(similarity(normalise(value), normalise(query)))
-            if sim:
-                row_indexes.append((sum(sim) / len(sim), i))
-                if 1.0 in sim:
-                    perfect_match.add(i)
+                for j, values in enumerate(search_values[i]):
+                    if j in exclude_column_indexes:
+                        continue
+                    if term.column is not None and term.column != j:
+                        continue
+                    for value in values:
+                        if match(term.operator, term.value, value):
+                            sim.append(similarity(value, term.value))
+            row_indexes.append((sum(sim) / len(sim) if sim else 0.0, i))
+            if 1.0 in sim:
+                perfect_match.add(i)
 
         # sort row indexes by similarity
         row_indexes = map(lambda x: x[1], sorted(row_indexes, reverse=True, key=lambda x: x[0]))
@@ -77,7 +457,7 @@ class Database:
                 break
 
             row = dict()
-            for i, value in enumerate(self.sheet_values[row_index]):
+            for i, value in enumerate(sheet_values[row_index]):
                 if not value:
                     continue
                 if i in exclude_column_indexes:
@@ -86,9 +466,9 @@ class Database:
                     continue
                 if i == word_column:
                     continue
-                row[self.header[i]] = value
+                row[header[i]] = value
             if row:
-                word = self.sheet_values[row_index][word_column]
+                word = sheet_values[row_index][word_column] if word_column < len(sheet_values[row_index]) else ''
                 if row_index in perfect_match:
                     word = f'__{word}__'
                 result.append((word, row))
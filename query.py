@@ -0,0 +1,128 @@
+import re
+from bisect import bisect_left, insort
+from dataclasses import dataclass
+from typing import Optional
+
+from util import normalise
+
+# `^=` must be checked before `=`
+OPERATORS = ('^=', '=', ':')
+AND_KEYWORD = 'AND'
+OR_KEYWORD = 'OR'
+
+
+@dataclass
+class Term:
+    value: str
+    column: Optional[int] = None
+    operator: str = ':'
+
+
+def match(operator: str, query: str, value: str) -> bool:
+    if operator == '=':
+        return value == query
+    if operator == '^=':
+        return value.startswith(query)
+    return query in value
+
+
+def parse_term(token: str, columns: dict) -> Optional[Term]:
+    """ `열이름<연산자>값` 형태의 토큰을 `Term`으로 바꿉니다. 열 이름이 없으면 `None`을 반환합니다. """
+    for operator in OPERATORS:
+        name, found, value = token.partition(operator)
+        if found and normalise(name) in columns:
+            return Term(normalise(value.strip('"')), columns[normalise(name)], operator)
+    return None
+
+
+def parse_query(query: str, columns: dict) -> list:
+    """
+    검색어를 `OR`로 묶인 `AND` 조건들의 목록으로 바꿉니다.
+
+    `품사=명사`는 완전 일치, `단어^=ka`는 접두사 일치, `의미:물`은 부분 일치입니다.
+    열 이름이 없는 부분은 띄어쓰기를 포함해 입력한 그대로 하나의 검색어로 취급하며, 모든 열에서 부분 일치로 검색합니다.
+    `columns`는 정규화된 열 이름과 열 인덱스의 딕셔너리입니다.
+    """
+    groups = [list()]
+    words = list()
+    plain = True
+
+    def flush():
+        # keep the text between the first and the last word as typed
+        if words:
+            groups[-1].append(Term(normalise(query[words[0].start():words[-1].end()])))
+            words.clear()
+
+    for token in re.finditer(r'[^\s"]*"[^"]*"|\S+', query):
+        if token.group() == OR_KEYWORD:
+            flush()
+            groups.append(list())
+            plain = False
+            continue
+        if token.group() == AND_KEYWORD:
+            flush()
+            plain = False
+            continue
+
+        term = parse_term(token.group(), columns)
+        if term is None:
+            words.append(token)
+        else:
+            flush()
+            groups[-1].append(term)
+            plain = False
+    flush()
+
+    # a query without column names or keywords is searched as a whole, as before
+    groups = [terms for terms in groups if terms]
+    if plain or not groups:
+        groups = [[Term(normalise(query))]]
+    return groups
+
+
+class ColumnIndex:
+    """ 한 열의 정규화된 값에서 그 값을 가진 행 ID들을 찾는 역색인입니다. """
+
+    def __init__(self):
+        self.rows = dict()
+        self.keys = None
+
+    def add(self, row_id: int, values: list):
+        for value in values:
+            rows = self.rows.get(value)
+            if rows is None:
+                rows = self.rows[value] = set()
+                if self.keys is not None:
+                    insort(self.keys, value)
+            rows.add(row_id)
+
+    def remove(self, row_id: int, values: list):
+        for value in values:
+            rows = self.rows.get(value)
+            if rows is None:
+                continue
+            rows.discard(row_id)
+            if not rows:
+                del self.rows[value]
+                if self.keys is not None:
+                    self.keys.pop(bisect_left(self.keys, value))
+
+    def find(self, operator: str, query: str) -> set:
+        if operator == '=':
+            return set(self.rows.get(query, set()))
+
+        result = set()
+        if operator == '^=':
+            # sorted keys with the same prefix are adjacent
+            if self.keys is None:
+                self.keys = sorted(self.rows)
+            i = bisect_left(self.keys, query)
+            while i < len(self.keys) and self.keys[i].startswith(query):
+                result |= self.rows[self.keys[i]]
+                i += 1
+            return result
+
+        for key, rows in self.rows.items():
+            if query in key:
+                result |= rows
+        return result
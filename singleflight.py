@@ -0,0 +1,24 @@
+from asyncio import create_task, shield
+
+
+class SingleFlight:
+    """ 같은 키로 동시에 들어온 호출들이 하나의 실행 결과를 함께 기다리게 합니다. """
+
+    def __init__(self):
+        self.flights = dict()
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, function, *args):
+        """ `key`로 실행 중인 호출이 있으면 그 결과를 기다리고, 없으면 `function(*args)`를 실행합니다. """
+        self.calls += 1
+        task = self.flights.get(key)
+        if task is None:
+            task = create_task(function(*args))
+            self.flights[key] = task
+            task.add_done_callback(lambda _: self.flights.pop(key, None))
+        else:
+            self.coalesced += 1
+
+        # a cancelled caller must not cancel the call other callers are waiting for
+        return await shield(task)